@@ -20,8 +20,10 @@
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #  SOFTWARE.
 
+import io
 import sys
 from PIL import Image
+import numpy as np
 import os
 import math
 
@@ -29,6 +31,8 @@ import math
 FONT_RATIO = 0.4
 ASCII_SCALE = "$@B%8&WM#*oahkbdpqwmZO0QLCJUYXzcvunxrjft/\\|()1{}[]?-_+~<>i!lI;:,\"^`'. "
 ASCII_SCALE_SIZE = len(ASCII_SCALE)
+SGR_PREFIX_BYTES = [f"\u001b[38;5;{i}m".encode('ascii') for i in range(256)]
+SGR_RESET_BYTES = b"\033[0m"
 
 COLORS_STEPS = [
     (0, 95),
@@ -48,9 +52,23 @@ def round_tint(tint: int):
     that each  rgb tint can have defined values : 0, 95, 135, 175, 215 and 255. We need to round the tint to the closest
     one. and return its indices. By default the function returns 0.
 
+    Above 95 the steps are 40 apart, so the closest one is found with a single division instead of scanning
+    `COLORS_STEPS` (same trick as tmux).
+
     :param tint: tint to round
     :return: The indices of the rounded tint or 0 if not in the [[0; 255]] interval.
     """
+    if tint < 48 or tint > 255:
+        return 0
+    if tint < 115:
+        return 1
+    return (tint - 35) // 40
+
+
+def _closest_step(tint: int):
+    """
+    Reference implementation of `round_tint` scanning `COLORS_STEPS`, a tie goes to the highest step.
+    """
     m = 0
     for step_low, step_max in COLORS_STEPS:
         if step_low <= tint <= step_max:
@@ -59,56 +77,66 @@ def round_tint(tint: int):
     return 0
 
 
-def get_xterm_color(r, g, b):
-    """
-    Get the xterm256 color closest to the given rgb color. Use the `round_tint` function to convert each tints. See the
-    `round_tint` documentation. Th returned number can be used as a xterm256 color code, it will be between 16 and 231.
-    :param r: RGB red tint
-    :param g: RGB green tint
-    :param b: RGB blue tint
-    :return:
-    """
-    rr = round_tint(r)
-    rg = round_tint(g)
-    rb = round_tint(b)
+assert all(round_tint(tint) == _closest_step(tint) for tint in range(-1, 257))
 
-    return 16 + rr * 36 + rg * 6 + rb
+
+TINT_LUT = np.array([round_tint(tint) for tint in range(256)], dtype=np.uint8)
 
 
-def get_char_from_light(light: int):
+def get_xterm_colors(tiles_rgb: np.ndarray):
     """
-    Get a character from the grayscale character list that match the light value. The light value must be between 0 and
-    255.
-    :param light: int representing a light level (between 0 and 255)
-    :return: a character that match the light level
+    Get the xterm256 colors closest to the given rgb colors. Each tint is rounded with a single gather in `TINT_LUT`
+    (the result of `round_tint` for every byte value, see the `round_tint` documentation) instead of calling
+    `round_tint` for every tile. The returned numbers can be used as xterm256 color codes, they will be between 16 and
+    231.
+    :param tiles_rgb: (..., 3) uint8 array of RGB colors
+    :return: an array of xterm256 color codes with the same leading shape
     """
-    index = int((light * (ASCII_SCALE_SIZE - 1)) / 255)
-    return ASCII_SCALE[index]
+    rr = TINT_LUT[tiles_rgb[..., 0]].astype(np.int32)
+    rg = TINT_LUT[tiles_rgb[..., 1]].astype(np.int32)
+    rb = TINT_LUT[tiles_rgb[..., 2]].astype(np.int32)
 
+    return 16 + rr * 36 + rg * 6 + rb
 
-def print_tile(tile: Image.Image):
-    """
-    Given PIL Image, return average value of grayscale value
-    """
-    width, height = tile.size
 
-    pixels = tile.getcolors(width * height)
+LIGHT_TO_CHAR_IDX = ((np.arange(256) * (ASCII_SCALE_SIZE - 1)) // 255).astype(np.uint8)
+ASCII_ARR = np.frombuffer(ASCII_SCALE.encode('ascii'), dtype=np.uint8)
 
-    most_frequent_pixel = pixels[0]
 
-    for count, color in pixels:
-        if count > most_frequent_pixel[0]:
-            most_frequent_pixel = (count, color)
+def get_chars(tiles_rgb: np.ndarray):
+    """
+    Get the characters from the grayscale character list that match the light of the given rgb colors. The light level
+    (between 0 and 255) is computed with the integer BT.601 luma formula and mapped to a character of `ASCII_SCALE`
+    through `LIGHT_TO_CHAR_IDX`.
+    :param tiles_rgb: (..., 3) uint8 array of RGB colors
+    :return: an uint8 array of ASCII character codes with the same leading shape
+    """
+    light = (tiles_rgb[..., 0].astype(np.uint32) * 299
+             + tiles_rgb[..., 1].astype(np.uint32) * 587
+             + tiles_rgb[..., 2].astype(np.uint32) * 114) // 1000
 
-    r, g, b = most_frequent_pixel[1]
+    return ASCII_ARR[LIGHT_TO_CHAR_IDX[light]]
 
-    light = r * 299/1000 + g * 587/1000 + b * 114/1000
 
-    char = get_char_from_light(light)
+def get_tiles_rgb(image: Image.Image, row_count: int, col_count: int):
+    """
+    Compute the average RGB color of every tile of the image. Shrinking the image to one pixel per tile with a box
+    filter averages each tile in Pillow's C code, and its pixels are read through `tobytes()` into a read-only array.
+    When the image splits into a whole number of tiles, `Image.reduce` is used instead as it is faster than a general
+    resize.
+    :param image: RGB PIL image
+    :param row_count: number of tile rows
+    :param col_count: number of tile columns
+    :return: a (row_count, col_count, 3) uint8 array
+    """
+    image_width, image_height = image.size
 
-    color = get_xterm_color(r, g, b)
+    if image_width % col_count == 0 and image_height % row_count == 0:
+        small = image.reduce((image_width // col_count, image_height // row_count))
+    else:
+        small = image.resize((col_count, row_count), Image.BOX)
 
-    print("\u001b[38;5;" + str(color) + "m" + char, end="\033[0m")
+    return np.frombuffer(small.tobytes(), dtype=np.uint8).reshape(row_count, col_count, 3)
 
 
 def get_terminal_sizes():
@@ -116,21 +144,60 @@ def get_terminal_sizes():
     return lines, columns, columns / lines
 
 
-def print_vertical_margin(size: int):
-    for i in range(size):
-        print("")
+def render_row(codes: np.ndarray, chars: np.ndarray):
+    """
+    Build a single row of the box. The color escape sequence is only emitted when the color changes from the previous
+    character of the row, and the color is reset before the right border.
+    :param codes: (cols,) array of xterm256 color codes
+    :param chars: (cols,) uint8 array of ASCII character codes
+    :return: the encoded row, border and line feed included
+    """
+    row = bytearray(b"|")
+    previous = -1
+    for color, char in zip(codes.tolist(), chars.tolist()):
+        if color != previous:
+            row += SGR_PREFIX_BYTES[color]
+            previous = color
+        row.append(char)
+    row += SGR_RESET_BYTES + b"|\n"
 
+    return row
 
-def print_top_border(content_width: int):
-    print("+", end="")
-    for i in range(content_width):
-        print("-", end="")
-    print("+")
 
+def render_frame(codes: np.ndarray, chars: np.ndarray, vertical_margin: int):
+    """
+    Build the whole frame (margins, box and colored characters) as a single buffer so it can be written at once.
+    :param codes: (rows, cols) array of xterm256 color codes
+    :param chars: (rows, cols) uint8 array of ASCII character codes
+    :param vertical_margin: number of empty lines printed above and below the box
+    :return: the encoded frame to write to the terminal
+    """
+    col_count = codes.shape[1]
+    border = b"+" + b"-" * col_count + b"+\n"
+
+    rows = map(render_row, codes, chars)
+
+    return b"".join([b"\n" * vertical_margin, border, *rows, border, b"\n" * vertical_margin])
+
+
+def write_frame(frame: bytes):
+    """
+    Write the frame straight to the standard output file descriptor, bypassing the text layer since the frame is pure
+    ASCII. `os.write` may write only part of the buffer, so it is called until everything is written. When the standard
+    output is not backed by a file descriptor (StringIO, captured output, ...), the frame goes through `sys.stdout`.
+    :param frame: encoded frame
+    """
+    try:
+        fd = sys.stdout.fileno()
+    except io.UnsupportedOperation:
+        sys.stdout.write(frame.decode('ascii'))
+        return
 
-def print_horizontal_margin(size: int):
-    for i in range(size):
-        print("", end="")
+    sys.stdout.flush()
+    view = memoryview(frame)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
 
 
 def main():
@@ -157,53 +224,20 @@ def main():
         tile_height = math.floor(image_height / grid_height)
         tile_width = int(tile_height * image_ratio)
 
-    image_row_count = math.floor(image_height / tile_height)
-    image_col_count = math.floor(image_width / tile_width)
-
-    while image_row_count >= grid_height:
-        tile_height += 1
-        image_row_count = math.floor(image_height / tile_height)
+    # Smallest tiles that keep the row and column counts strictly below the grid size
+    tile_height = max(tile_height, image_height // grid_height + 1)
+    tile_width = max(tile_width, image_width // grid_width + 1)
 
-    while image_col_count >= grid_width:
-        tile_width += 1
-        image_col_count = math.floor(image_width / tile_width)
+    image_row_count = image_height // tile_height
+    image_col_count = image_width // tile_width
 
     vertical_margin = grid_height - image_row_count
-    horizontal_margin = grid_width - image_col_count
-
-    print_vertical_margin(vertical_margin // 2)
-
-    print_horizontal_margin(horizontal_margin // 2)
-
-    print_top_border(image_col_count)
-
-    for row in range(image_row_count):
-        y1 = row * tile_height
-
-        if row == image_row_count - 1:
-            y2 = image_height
-        else:
-            y2 = (row + 1) * tile_height
-
-        print_horizontal_margin(horizontal_margin // 2)
-        print("|", end="")
-
-        for col in range(image_col_count):
-            x1 = col * tile_width
-
-            x2 = image_width if col == image_col_count - 1 else (col + 1) * tile_width
-
-            tile = image.crop((x1, y1, x2, y2))
-
-            print_tile(tile)
-
-        print("|")
-
-    print_horizontal_margin(horizontal_margin // 2)
 
-    print_top_border(image_col_count)
+    tiles_rgb = get_tiles_rgb(image, image_row_count, image_col_count)
+    codes = get_xterm_colors(tiles_rgb)
+    chars = get_chars(tiles_rgb)
 
-    print_vertical_margin(vertical_margin // 2)
+    write_frame(render_frame(codes, chars, vertical_margin // 2))
 
 
 if __name__ == '__main__':